@@ -1,15 +1,96 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Form, HTTPException, Query, Request, UploadFile
+from fastapi.responses import Response
 from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
 from typing import Literal
 import logging
 
-from utils.fraud_utils import analyzer
+import orjson
+
+from utils.fraud_utils import AnalysisType, VisionConfig, analyzer
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Image Fraud Detection API")
+class ORJSONResponse(Response):
+    """JSON response rendered with orjson, which serializes in native code and emits bytes directly."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Cold pods would otherwise pay gRPC channel setup and OAuth token fetch on their first request
+    try:
+        await analyzer.warm_up()
+    except Exception as e:
+        logger.error("Client warm-up failed: %s", e, exc_info=True)
+    yield
+
+app = FastAPI(title="Image Fraud Detection API", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+class RequestSizeLimitMiddleware:
+    """Pure ASGI middleware rejecting request bodies larger than max_size, chunked uploads included."""
+
+    def __init__(self, app, max_size: int):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Declared sizes are rejected before FastAPI reads or parses anything
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_size:
+            logger.error("Request body too large: %s bytes", content_length.decode())
+            await self.reject(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    exceeded = True
+                    # FastAPI re-raises HTTPException from body parsing, anything else is caught below
+                    raise HTTPException(status_code=413)
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # Once the limit trips, whatever the app answers is replaced by the 413 below
+            if exceeded and not response_started:
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+
+        if exceeded and not response_started:
+            logger.error("Request body too large: more than %d bytes received", self.max_size)
+            await self.reject(scope, receive, send)
+
+    async def reject(self, scope, receive, send):
+        response = ORJSONResponse(
+            status_code=413,
+            content={"detail": f"Request body exceeds maximum allowed size of {self.max_size} bytes"}
+        )
+        await response(scope, receive, send)
+
+app.add_middleware(RequestSizeLimitMiddleware, max_size=VisionConfig.MAX_REQUEST_SIZE)
 
 class ImageRequest(BaseModel):
     source_type: Literal['base64'] = Field(
@@ -20,30 +101,80 @@ class ImageRequest(BaseModel):
         ...,
         description="Image data (base64)"
     )
-    analysis_type: Literal['web_search', 'exif', 'classification'] = Field(
+    analysis_type: AnalysisType = Field(
         ...,
         description="Type of analysis to perform"
     )
 
-@app.post("/api/v1.1/analyze", response_class=JSONResponse)
+@app.post("/api/v1.1/analyze", response_class=ORJSONResponse)
 async def analyze_fraud(request: ImageRequest):
 
     try:
-        logger.info(f"Received request for analysis type: {request.analysis_type}")
+        logger.info("Received request for analysis type: %s", request.analysis_type)
 
         # Perform analysis by sending the base64 encoded image and analysis type (web search, EXIF metadata, or classification)
-        response = analyzer.analyze(
+        response = await analyzer.analyze(
             base64_content=request.source,
             analysis_type=request.analysis_type
         )
 
-        return JSONResponse(content=response)
+        return ORJSONResponse(content=response)
+
+    except ValueError as e:
+        logger.error("Validation error: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error("Unexpected error: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+
+@app.post("/api/v1.1/analyze_binary", response_class=ORJSONResponse)
+async def analyze_fraud_binary(
+    file: UploadFile = File(..., description="Raw image file"),
+    analysis_type: AnalysisType = Form(..., description="Type of analysis to perform")
+):
+
+    try:
+        logger.info("Received binary request for analysis type: %s", analysis_type)
+
+        # Raw bytes skip the base64 inflation on the wire and the decode step entirely
+        image_data = await file.read()
+        response = await analyzer.analyze(
+            image_bytes=image_data,
+            analysis_type=analysis_type
+        )
+
+        return ORJSONResponse(content=response)
+
+    except ValueError as e:
+        logger.error("Validation error: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error("Unexpected error: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+
+@app.post("/api/v1.1/analyze_stream", response_class=ORJSONResponse)
+async def analyze_fraud_stream(
+    request: Request,
+    analysis_type: AnalysisType = Query(..., description="Type of analysis to perform")
+):
+
+    try:
+        logger.info("Received streamed request for analysis type: %s", analysis_type)
+
+        # The base64 body is decoded chunk by chunk, so the full string is never held in memory
+        image_data = await analyzer.decode_base64_stream(request.stream())
+        response = await analyzer.analyze(
+            image_bytes=image_data,
+            analysis_type=analysis_type
+        )
+
+        return ORJSONResponse(content=response)
 
     except ValueError as e:
-        logger.error(f"Validation error: {e}")
+        logger.error("Validation error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Unexpected error: {e}", exc_info=True)
+        logger.error("Unexpected error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
 if __name__ == "__main__":
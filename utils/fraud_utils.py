@@ -1,20 +1,33 @@
-import base64
+import asyncio
+import hashlib
 import io
-from typing import Dict, Literal, Tuple
+import os
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Literal, Optional, Tuple
 from dataclasses import dataclass
 import logging
 
+import orjson
 from PIL import Image
-import piexif
+import pybase64
+import pyexiv2
 from google.cloud import vision, aiplatform
 from google.cloud.aiplatform.gapic.schema import predict
 from google.api_core import exceptions as google_exceptions
+from google.protobuf.json_format import MessageToDict
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# libexiv2 prints parser warnings straight to stdout rather than through logging, so only let errors through
+pyexiv2.set_log_level(3)
+
+# pyexiv2 keeps global state in C++ and isn't thread safe, while analyze_exif runs in worker threads
+EXIV2_LOCK = threading.Lock()
+
 # Type definitions
-AnalysisType = Literal['web_search', 'classification', 'exif']
+AnalysisType = Literal['web_search', 'classification', 'exif', 'all']
 
 @dataclass
 class VisionConfig:
@@ -22,21 +35,62 @@ class VisionConfig:
     LOCATION: str = "us-central1"
     ENDPOINT_ID: str = "6057421763162144768"
     MAX_IMAGE_SIZE: int = 1_500_000  # 1.5MB in bytes
+    MAX_REQUEST_SIZE: int = 2_200_000  # base64 of MAX_IMAGE_SIZE plus line breaks and JSON overhead
+    WARM_UP_TIMEOUT: float = 5.0  # Seconds, startup blocks on warm-up so it must stay short
+    CACHE_SIZE: int = int(os.environ.get("ANALYSIS_CACHE_SIZE", "256"))  # Cached results, 0 disables the cache
+
+# Whitespace that may appear in MIME-wrapped base64 and has to be dropped before 4-char alignment
+BASE64_WHITESPACE = b' \t\r\n'
+
+# Leading bytes of the containers we read EXIF from: JPEG, little/big-endian TIFF and PNG (WebP is checked separately)
+EXIF_CONTAINER_SIGNATURES = (b'\xff\xd8', b'II*\x00', b'MM\x00*', b'\x89PNG\r\n\x1a\n')
+
+class AnalysisCache:
+    """Thread-safe LRU of analysis results keyed by image SHA-256 and analysis type."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str]) -> Optional[Dict]:
+        with self._lock:
+            serialized = self._entries.get(key)
+            if serialized is None:
+                return None
+            self._entries.move_to_end(key)
+        # Results are stored serialized so callers always get their own copy
+        return orjson.loads(serialized)
+
+    def put(self, key: Tuple[str, str], result: Dict) -> None:
+        if self.maxsize <= 0:
+            return
+        # analyze_exif reports failures as an "error" entry rather than raising, those must not be served again
+        if "error" in result or any(isinstance(value, dict) and "error" in value for value in result.values()):
+            return
+        serialized = orjson.dumps(result)
+        with self._lock:
+            self._entries[key] = serialized
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
 
 class ImageAnalyzer:
     def __init__(self):
         self._vision_client = None
         self._vertex_client = None
+        self._cache = AnalysisCache(VisionConfig.CACHE_SIZE)
 
     @property
     def vision_client(self):
         # We only want to do this once per user (obviously there is no user mgmt happening in this API but it's a best practice)
         if not self._vision_client:
             try:
-                self._vision_client = vision.ImageAnnotatorClient()
+                # The async client multiplexes concurrent RPCs over one HTTP/2 channel on the event loop
+                self._vision_client = vision.ImageAnnotatorAsyncClient()
                 logger.info("Vision client initialized successfully")
             except Exception as e:
-                logger.error(f"Failed to initialize Vision client: {e}")
+                logger.error("Failed to initialize Vision client: %s", e)
                 raise
         return self._vision_client
 
@@ -45,68 +99,144 @@ class ImageAnalyzer:
         # We only want to do this once per user (obviously there is no user mgmt happening in this API but it's a best practice)
         if not self._vertex_client:
             try:
-                self._vertex_client = aiplatform.gapic.PredictionServiceClient(
+                self._vertex_client = aiplatform.gapic.PredictionServiceAsyncClient(
                     client_options={"api_endpoint": f"{VisionConfig.LOCATION}-aiplatform.googleapis.com"}
                 )
                 logger.info("Vertex client initialized successfully")
             except Exception as e:
-                logger.error(f"Failed to initialize Vertex client: {e}")
+                logger.error("Failed to initialize Vertex client: %s", e)
                 raise
         return self._vertex_client
 
-    def validate_image(self, base64_string: str) -> Tuple[bytes, Image.Image]:
-        """Validate and decode base64 image, returning both bytes and PIL Image."""
+    async def warm_up(self) -> None:
+        """Open both gRPC channels and mint auth tokens so the first real request doesn't pay for it."""
+        logger.info("Warming up Vision and Vertex clients")
+        endpoint = self.vertex_client.endpoint_path(
+            project=VisionConfig.PROJECT,
+            location=VisionConfig.LOCATION,
+            endpoint=VisionConfig.ENDPOINT_ID
+        )
+        # Empty requests are cheap and rejected server-side, the point is the round-trip itself.
+        # The gapic defaults retry for up to 10 minutes, which would keep the pod unready, so fail fast instead
+        results = await asyncio.gather(
+            self.vision_client.batch_annotate_images(requests=[], retry=None, timeout=VisionConfig.WARM_UP_TIMEOUT),
+            self.vertex_client.predict(endpoint=endpoint, instances=[], retry=None, timeout=VisionConfig.WARM_UP_TIMEOUT),
+            return_exceptions=True
+        )
+        for name, result in zip(("Vision", "Vertex"), results):
+            # Only the expected rejection of an empty request proves the channel and credentials work
+            if isinstance(result, google_exceptions.InvalidArgument):
+                logger.info("%s warm-up call was rejected as expected, channel is ready", name)
+            elif isinstance(result, Exception):
+                logger.warning("%s warm-up failed: %s: %s", name, result.__class__.__name__, result)
+        logger.info("Client warm-up completed")
+
+    def decode_image(self, base64_string: str) -> bytes:
+        """Decode a base64 image string into raw bytes."""
         try:
-            logger.info("Starting image validation")
-            cleaned_string = base64_string.replace('\n', '').replace('\r', '').strip()
-            image_data = base64.b64decode(cleaned_string)
+            logger.info("Decoding base64 image")
+            # Every 4 base64 chars decode to 3 bytes, so oversize payloads can be rejected before decoding anything.
+            # Line breaks are only counted (a full scan each) when the raw length alone is already over the limit
+            size_limit = VisionConfig.MAX_IMAGE_SIZE + 3
+            if (len(base64_string) * 3) // 4 > size_limit:
+                payload_length = len(base64_string) - base64_string.count('\n') - base64_string.count('\r')
+                if (payload_length * 3) // 4 > size_limit:
+                    raise ValueError(f"Image size exceeds maximum allowed size of {VisionConfig.MAX_IMAGE_SIZE} bytes")
 
-            # Check file size as it can't be larger than 1.5MB
-            size = len(image_data)
-            logger.info(f"Image size: {size} bytes")
-            if size > VisionConfig.MAX_IMAGE_SIZE:
-                raise ValueError(f"Image size ({size} bytes) exceeds maximum allowed size of {VisionConfig.MAX_IMAGE_SIZE} bytes")
+            # Non-alphabet characters (MIME line breaks, padding whitespace) are skipped by the decoder itself
+            return pybase64.b64decode(base64_string, validate=False)
+        except Exception as e:
+            logger.error("Image decoding failed: %s", e)
+            raise ValueError(f"Invalid image data: {str(e)}")
+
+    def check_image_size(self, image_data: bytes) -> None:
+        """Reject images larger than the configured maximum size."""
+        # Check file size as it can't be larger than 1.5MB
+        size = len(image_data)
+        logger.info("Image size: %d bytes", size)
+        if size > VisionConfig.MAX_IMAGE_SIZE:
+            raise ValueError(f"Image size ({size} bytes) exceeds maximum allowed size of {VisionConfig.MAX_IMAGE_SIZE} bytes")
+
+    async def decode_base64_stream(self, chunks: AsyncIterator[bytes]) -> bytes:
+        """Incrementally decode a streamed base64 body, aborting as soon as it exceeds the size limit."""
+        try:
+            logger.info("Starting streamed base64 decode")
+            # Decoded pieces are joined once at the end, avoiding bytearray regrowth and a final bytes() copy
+            decoded_chunks = []
+            decoded_size = 0
+            remainder = b''
+            async for chunk in chunks:
+                chunk = remainder + chunk.translate(None, BASE64_WHITESPACE)
+                # Only decode whole 4-char groups, the tail is carried into the next chunk
+                aligned = len(chunk) - (len(chunk) % 4)
+                remainder = chunk[aligned:]
+                decoded = pybase64.b64decode(chunk[:aligned], validate=False)
+                decoded_chunks.append(decoded)
+                decoded_size += len(decoded)
+
+                if decoded_size > VisionConfig.MAX_IMAGE_SIZE:
+                    raise ValueError(f"Image size exceeds maximum allowed size of {VisionConfig.MAX_IMAGE_SIZE} bytes")
+
+            if remainder:
+                decoded_chunks.append(pybase64.b64decode(remainder, validate=False))
+
+            return b''.join(decoded_chunks)
+        except Exception as e:
+            logger.error("Streamed decode failed: %s", e)
+            raise ValueError(f"Invalid image data: {str(e)}")
+
+    def validate_image_bytes(self, image_data: bytes) -> Image.Image:
+        """Validate raw image bytes, returning a PIL Image."""
+        try:
+            self.check_image_size(image_data)
 
             # Validate image format
             try:
+                # Image.open only parses the header, pixel data is decoded lazily by whoever needs it.
+                # BytesIO shares an immutable bytes buffer without copying, wrapping a memoryview would force a copy
                 pil_image = Image.open(io.BytesIO(image_data))
-                pil_image.verify()
-                pil_image = Image.open(io.BytesIO(image_data))  # Reopen after verify
-                logger.info(f"Image validated successfully. Format: {pil_image.format}")
-                return image_data, pil_image
+                logger.info("Image validated successfully. Format: %s, size: %s", pil_image.format, pil_image.size)
+                return pil_image
             except Exception as e:
-                logger.error(f"Image validation failed: {e}")
+                logger.error("Image validation failed: %s", e)
                 raise ValueError(f"Invalid image format: {str(e)}")
 
         except Exception as e:
-            logger.error(f"Image validation failed: {e}")
+            logger.error("Image validation failed: %s", e)
             raise ValueError(f"Invalid image data: {str(e)}")
 
-    def process_web_detection(self, image_data: bytes) -> Dict:
+    async def process_web_detection(self, image_data: bytes) -> Dict:
         """Process image through Vision API's web detection."""
         try:
             logger.info("Starting web detection")
             image = vision.Image(content=image_data)
-            web_detection = self.vision_client.web_detection(image=image).web_detection
+            web_detection = (await self.vision_client.web_detection(image=image)).web_detection
 
-            is_fraud = bool(web_detection.full_matching_images)
-            matching_count = len(web_detection.full_matching_images) if is_fraud else 0
+            # Walk each repeated proto field once and derive everything else from the lists
+            full_urls = [img.url for img in web_detection.full_matching_images]
+            partial_urls = [img.url for img in web_detection.partial_matching_images]
+            matching_count = len(full_urls)
 
-            logger.info(f"Web detection completed. Found {matching_count} matching images")
+            logger.info("Web detection completed. Found %d matching images", matching_count)
             return {
-                "is_fraud": is_fraud,
+                "is_fraud": matching_count > 0,
                 "matching_images_count": matching_count,
-                "full_matching_images": [img.url for img in web_detection.full_matching_images],
-                "partial_matching_images": [img.url for img in web_detection.partial_matching_images]
+                "full_matching_images": full_urls,
+                "partial_matching_images": partial_urls
             }
         except Exception as e:
-            logger.error(f"Web detection failed: {e}")
+            logger.error("Web detection failed: %s", e)
             raise ValueError(f"Web detection failed: {str(e)}")
 
-    def classify_image(self, encoded_content: str) -> Dict:
-        """Classify image using Vertex AI."""
+    async def classify_image(self, encoded_content: Optional[str] = None, image_data: Optional[bytes] = None) -> Dict:
+        """Classify image using Vertex AI. Raw bytes are base64-encoded here when no encoded string is available."""
         try:
             logger.info("Starting image classification")
+            if encoded_content is None:
+                # Vertex needs base64, pybase64 uses the SIMD encoder where the CPU supports it
+                encoded_content = pybase64.b64encode(image_data).decode('ascii')
+
+            # Online prediction only takes inline base64 content, GCS sources are limited to batch prediction
             instance = predict.instance.ImageClassificationPredictionInstance(
                 content=encoded_content,
             ).to_value()
@@ -122,19 +252,15 @@ class ImageAnalyzer:
                 endpoint=VisionConfig.ENDPOINT_ID
             )
 
-            response = self.vertex_client.predict(
+            response = await self.vertex_client.predict(
                 endpoint=endpoint,
                 instances=[instance],
                 parameters=parameters
             )
 
-            predictions = []
-            for pred in response.predictions:
-                pred_dict = dict(pred)
-                pred_dict['confidences'] = list(pred_dict['confidences'])
-                pred_dict['displayNames'] = list(pred_dict['displayNames'])
-                pred_dict['ids'] = list(pred_dict['ids'])
-                predictions.append(pred_dict)
+            # Convert each prediction Value on the raw protobuf in one pass instead of unwrapping each field
+            response_pb = type(response).pb(response)
+            predictions = [MessageToDict(prediction) for prediction in response_pb.predictions]
 
             logger.info("Classification completed successfully")
             return {
@@ -144,16 +270,32 @@ class ImageAnalyzer:
                 "predictions": predictions
             }
         except Exception as e:
-            logger.error(f"Classification failed: {e}")
+            logger.error("Classification failed: %s", e)
             raise ValueError(f"Classification failed: {str(e)}")
 
-    def analyze_exif(self, pil_image: Image.Image) -> Dict:
-        """Analyze EXIF metadata from PIL Image."""
+    def analyze_exif(self, image_data: bytes) -> Dict:
+        """Analyze EXIF metadata straight from the raw image bytes."""
         try:
             logger.info("Starting EXIF analysis")
-            if 'exif' in pil_image.info:
-                exif_data = piexif.load(pil_image.info['exif'])
+            # The exif path skips PIL validation, so only hand the parser bytes that look like an EXIF-capable image
+            is_webp = image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP'
+            if not image_data.startswith(EXIF_CONTAINER_SIGNATURES) and not is_webp:
+                # Formats without EXIF support (GIF, BMP, ...) carry no EXIF for our purposes
+                exif_data = {}
             else:
+                # libexiv2 parses the metadata in C++ and hands back already-decoded strings
+                try:
+                    with EXIV2_LOCK, pyexiv2.ImageData(image_data) as exif_image:
+                        try:
+                            exif_data = exif_image.read_exif()
+                        except UnicodeDecodeError:
+                            # Any non-UTF-8 tag (Latin-1 Artist, vendor strings, ...) fails the strict decode, latin-1 never does
+                            exif_data = exif_image.read_exif(encoding='latin-1')
+                except RuntimeError:
+                    # Formats exiv2 can't read carry no EXIF for our purposes
+                    exif_data = {}
+
+            if not exif_data:
                 logger.info("No EXIF data found in image")
                 return {
                     "camera_model": "",
@@ -164,10 +306,10 @@ class ImageAnalyzer:
                 }
 
             analysis = {
-                "camera_model": exif_data.get('0th', {}).get(piexif.ImageIFD.Model, b'').decode('utf-8', 'ignore'),
-                "software": exif_data.get('0th', {}).get(piexif.ImageIFD.Software, b'').decode('utf-8', 'ignore'),
-                "datetime_original": exif_data.get('Exif', {}).get(piexif.ExifIFD.DateTimeOriginal, b'').decode('utf-8', 'ignore'),
-                "datetime_digitized": exif_data.get('Exif', {}).get(piexif.ExifIFD.DateTimeDigitized, b'').decode('utf-8', 'ignore'),
+                "camera_model": exif_data.get('Exif.Image.Model', ''),
+                "software": exif_data.get('Exif.Image.Software', ''),
+                "datetime_original": exif_data.get('Exif.Photo.DateTimeOriginal', ''),
+                "datetime_digitized": exif_data.get('Exif.Photo.DateTimeDigitized', ''),
                 "warnings": []
             }
 
@@ -179,32 +321,106 @@ class ImageAnalyzer:
             logger.info("EXIF analysis completed successfully")
             return analysis
         except Exception as e:
-            logger.error(f"EXIF analysis failed: {e}")
+            logger.error("EXIF analysis failed: %s", e)
             return {"error": f"EXIF analysis failed: {str(e)}"}
 
-    def analyze(self, base64_content: str, analysis_type: AnalysisType) -> Dict:
-        """Main analysis method."""
+    def prepare_image(
+        self,
+        analysis_type: AnalysisType,
+        base64_content: Optional[str] = None,
+        image_bytes: Optional[bytes] = None
+    ) -> Tuple[bytes, str]:
+        """Decode (if needed) and validate the incoming image, returning the raw bytes and their SHA-256."""
+        if image_bytes is not None:
+            image_data = image_bytes
+        elif base64_content is not None:
+            image_data = self.decode_image(base64_content)
+        else:
+            raise ValueError("Either base64_content or image_bytes must be provided")
+
+        # EXIF lives in the file header and exiv2 reads it from the bytes, so PIL isn't needed there
+        if analysis_type == 'exif':
+            self.check_image_size(image_data)
+        else:
+            self.validate_image_bytes(image_data)
+
+        # Hashed here so it runs in the same worker thread as decoding rather than on the event loop
+        return image_data, hashlib.sha256(image_data).hexdigest()
+
+    async def analyze(
+        self,
+        analysis_type: AnalysisType,
+        base64_content: Optional[str] = None,
+        image_bytes: Optional[bytes] = None
+    ) -> Dict:
+        """Main analysis method. Accepts either a base64 string or raw image bytes."""
+        if analysis_type == 'all':
+            return await self.analyze_all(base64_content=base64_content, image_bytes=image_bytes)
+
         try:
-            logger.info(f"Starting analysis of type: {analysis_type}")
+            logger.info("Starting analysis of type: %s", analysis_type)
 
-            # Validate image first
-            image_data, pil_image = self.validate_image(base64_content)
+            # Validate image first. Decoding and PIL parsing are CPU-bound, so they stay off the event loop
+            image_data, image_hash = await asyncio.to_thread(self.prepare_image, analysis_type, base64_content, image_bytes)
 
-            analysis_methods = {
-                'web_search': lambda: self.process_web_detection(image_data), # Notice we're using the decoded image data
-                'classification': lambda: self.classify_image(base64_content), # Notice we're using the original base64 string from the initial request
-                'exif': lambda: self.analyze_exif(pil_image) # Notice w'ere using a PIL object
-            }
+            # Resubmitted images are served from the cache instead of hitting Vision/Vertex again
+            cache_key = (image_hash, analysis_type)
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                logger.info("Cache hit for analysis type: %s", analysis_type)
+                return cached
 
-            if analysis_type not in analysis_methods:
+            if analysis_type == 'web_search':
+                result = await self.process_web_detection(image_data) # Notice we're using the decoded image data
+            elif analysis_type == 'classification':
+                result = await self.classify_image(base64_content, image_data) # Notice we're using the original base64 string when there is one
+            elif analysis_type == 'exif':
+                result = await asyncio.to_thread(self.analyze_exif, image_data) # Notice we're using the decoded image data as well
+            else:
                 raise ValueError(f"Invalid analysis type: {analysis_type}")
 
-            result = analysis_methods[analysis_type]()
-            logger.info(f"Analysis completed successfully for type: {analysis_type}")
+            self._cache.put(cache_key, result)
+            logger.info("Analysis completed successfully for type: %s", analysis_type)
+            return result
+
+        except Exception as e:
+            logger.error("Analysis failed: %s", e)
+            raise
+
+    async def analyze_all(self, base64_content: Optional[str] = None, image_bytes: Optional[bytes] = None) -> Dict:
+        """Run web search, classification and EXIF analysis concurrently on a single decode."""
+        try:
+            logger.info("Starting analysis of type: all")
+            image_data, image_hash = await asyncio.to_thread(self.prepare_image, 'all', base64_content, image_bytes)
+
+            cache_key = (image_hash, 'all')
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                logger.info("Cache hit for analysis type: all")
+                return cached
+
+            # Build the Vertex payload once up front
+            if base64_content is None:
+                base64_content = pybase64.b64encode(image_data).decode('ascii')
+
+            # Both RPCs are awaited on the event loop while the EXIF parse runs in a worker thread
+            web_search, classification, exif = await asyncio.gather(
+                self.process_web_detection(image_data),
+                self.classify_image(base64_content),
+                asyncio.to_thread(self.analyze_exif, image_data)
+            )
+
+            result = {
+                "web_search": web_search,
+                "classification": classification,
+                "exif": exif
+            }
+            self._cache.put(cache_key, result)
+            logger.info("Analysis completed successfully for type: all")
             return result
 
         except Exception as e:
-            logger.error(f"Analysis failed: {e}")
+            logger.error("Analysis failed: %s", e)
             raise
 
 # Create a singleton instance of our analyzer